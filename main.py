@@ -1,11 +1,23 @@
+import errno
+import fcntl
+import functools
 import hashlib
+import io
+import itertools
 import json
 import logging
+import mmap
 import os
+import platform
+import queue
 import shutil
+import ssl
 import sys
+import threading
 import time
-from typing import Dict, Iterable, List, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional, Set, Tuple, Union
 from urllib.parse import urlparse
 
 try:
@@ -13,6 +25,21 @@ try:
 except ImportError:
     smbclient = None
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None  # type: ignore
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+try:
+    import inotify_simple  # type: ignore
+except ImportError:
+    inotify_simple = None
+
 
 def get_env_var(name: str) -> str:
     """Вернёт обязательную переменную окружения или завершит процесс с ошибкой."""
@@ -35,11 +62,40 @@ TRIGGER_FILE = os.getenv("TRIGGER_FILE", "trigger.txt")
 RETRY_COUNT = int(os.getenv("RETRY_COUNT", "3"))
 RETRY_DELAY = int(os.getenv("RETRY_DELAY", "2"))
 MANIFEST_PREFIX = os.getenv("MANIFEST_PREFIX", "manifest")
+HASH_CACHE_FILE = os.getenv("HASH_CACHE_FILE", ".hash_cache.json")
 RUN_MODE = os.getenv("RUN_MODE", "trigger").lower()  # trigger | cron
+STABLE_CHECK = os.getenv("STABLE_CHECK", "poll").lower()  # poll | flock
+HASH_ALGO = os.getenv("HASH_ALGO", "sha256").lower()  # sha256 | blake3
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", str(min(8, os.cpu_count() or 1))))
 
 # SMB учетные данные (опционально)
 SMB_USERNAME = os.getenv("SMB_USERNAME")
 SMB_PASSWORD = os.getenv("SMB_PASSWORD")
+_SMB_KWARGS: Dict[str, str] = {}
+if SMB_USERNAME:
+    _SMB_KWARGS["username"] = SMB_USERNAME
+if SMB_PASSWORD:
+    _SMB_KWARGS["password"] = SMB_PASSWORD
+
+# Кеш хешей между запусками: путь -> algo, size, mtime_ns, inode, digest
+_hash_cache: Dict[str, Dict] = {}
+
+# Взводится фоновым потоком при событиях inotify в SOURCE_DIR
+_source_changed = threading.Event()
+
+# Директории на SMB, уже созданные за текущий проход
+_smb_created_dirs: Set[str] = set()
+
+# Размер блока при потоковом копировании
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+# Файлы не больше этого размера хешируются за одно чтение
+SMALL_FILE_SIZE = 1024 * 1024
+# Файлы больше этого размера хешируются через mmap
+MMAP_MIN_SIZE = 16 * 1024 * 1024
+# Сколько прочитанных блоков может ждать записи на SMB
+READ_AHEAD_CHUNKS = 4
+# Сколько файлов манифеста может быть в работе или ждать записи
+MANIFEST_WINDOW = 2 * MAX_WORKERS
 
 
 def is_smb_path(path: str) -> bool:
@@ -47,6 +103,7 @@ def is_smb_path(path: str) -> bool:
     return path.lower().startswith("smb://")
 
 
+@functools.lru_cache(maxsize=256)
 def parse_smb_path(path: str) -> tuple:
     """Разобрать SMB путь вида smb://host/share/path/file.
 
@@ -82,22 +139,173 @@ def smb_makedirs(smb_path: str) -> None:
     if not parent or parent == "":
         return
 
-    try:
-        kwargs = {}
-        if SMB_USERNAME:
-            kwargs["username"] = SMB_USERNAME
-        if SMB_PASSWORD:
-            kwargs["password"] = SMB_PASSWORD
+    smb_dir = rf"//{host}/{share}{parent}"
+    if smb_dir in _smb_created_dirs:
+        return
 
-        smbclient.mkdir(rf"//{host}/{share}{parent}", **kwargs)
+    try:
+        smbclient.mkdir(smb_dir, **_SMB_KWARGS)
+        _smb_created_dirs.add(smb_dir)
     except Exception as exc:
         # Директория может уже существовать, игнорируем некоторые ошибки
         if "exist" not in str(exc).lower():
             logging.warning("Ошибка при создании директории SMB %s: %s", smb_path, exc)
+        else:
+            _smb_created_dirs.add(smb_dir)
+
+
+def new_hasher() -> Any:
+    """Создать хешер для алгоритма HASH_ALGO.
+
+    Для SHA256 используется OpenSSL с usedforsecurity=False: хеш нужен для
+    контроля целостности, а не для криптографии, поэтому FIPS-ограничения
+    не применяются.
+    """
+    if HASH_ALGO == "blake3":
+        return blake3.blake3()
+    return hashlib.new("sha256", usedforsecurity=False)
+
+
+def stream_copy(src_file: io.RawIOBase, dst_file: BinaryIO) -> str:
+    """Скопировать поток и вернуть хеш прочитанных данных.
+
+    Каждый блок читается один раз: он же хешируется и записывается.
+    """
+    h = new_hasher()
+    buf = bytearray(COPY_CHUNK_SIZE)
+    mv = memoryview(buf)
+    while True:
+        n = src_file.readinto(mv)
+        if not n:
+            break
+        h.update(mv[:n])
+        dst_file.write(mv[:n])
+    return h.hexdigest()
+
+
+def _read_ahead(
+    src_file: io.RawIOBase,
+    chunks: "queue.Queue[Union[bytes, BaseException]]",
+    stop: threading.Event,
+) -> None:
+    """Читать файл блоками в очередь, пустой блок означает конец файла."""
+    try:
+        while not stop.is_set():
+            chunk = src_file.read(COPY_CHUNK_SIZE) or b""
+            chunks.put(chunk)
+            if not chunk:
+                return
+    except BaseException as exc:  # pylint: disable=broad-except
+        chunks.put(exc)
+
+
+def pipelined_copy(src_file: io.RawIOBase, dst_file: BinaryIO) -> str:
+    """Скопировать поток, читая следующие блоки во время записи текущего.
+
+    Чтение идёт в отдельном потоке, поэтому сетевая запись (SMB) не
+    простаивает в ожидании диска. Вернёт хеш скопированных данных.
+    """
+    h = new_hasher()
+    chunks: "queue.Queue[Union[bytes, BaseException]]" = queue.Queue(
+        maxsize=READ_AHEAD_CHUNKS
+    )
+    stop = threading.Event()
+    reader = threading.Thread(
+        target=_read_ahead, args=(src_file, chunks, stop), daemon=True
+    )
+    reader.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if not chunk:
+                break
+            h.update(chunk)
+            dst_file.write(chunk)
+    finally:
+        # При ошибке записи освобождаем очередь, чтобы читатель завершился
+        stop.set()
+        while reader.is_alive():
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                reader.join(timeout=0.1)
+    return h.hexdigest()
+
 
+def local_copy_file(src: str, dst: str) -> str:
+    """Скопировать файл локально с сохранением метаданных, вернёт хеш."""
+    with open(src, "rb", buffering=0) as src_file:
+        with open(dst, "wb", buffering=COPY_CHUNK_SIZE) as dst_file:
+            digest = stream_copy(src_file, dst_file)
+    shutil.copystat(src, dst)
+    return digest
 
-def smb_copy_file(src: str, dst_smb: str) -> None:
-    """Скопировать локальный файл на SMB с опциональной аутентификацией."""
+
+def file_identity(stat: os.stat_result) -> Tuple[int, int, int]:
+    """Вернёт (размер, mtime_ns, inode), по которым видно, что файл не менялся."""
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def same_filesystem(src: str, dst_dir: str) -> bool:
+    """Проверить, что файл и целевая директория на одной файловой системе."""
+    return os.stat(src).st_dev == os.stat(dst_dir).st_dev
+
+
+def rename_file(src: str, dst: str) -> bool:
+    """Переименовать файл (os.replace) без копирования данных.
+
+    Вернёт False, если источник и цель в разных точках монтирования (EXDEV):
+    например, два bind-mount одной файловой системы в контейнере.
+    """
+    try:
+        os.replace(src, dst)
+    except OSError as exc:
+        if exc.errno == errno.EXDEV:
+            return False
+        raise
+    return True
+
+
+def kernel_copy_file(src: str, dst: str) -> bool:
+    """Скопировать файл локально средствами ядра (copy_file_range).
+
+    Данные не проходят через память процесса и не хешируются. Вернёт False,
+    если ядро или файловая система такое копирование не поддерживают.
+    """
+    if not hasattr(os, "copy_file_range"):
+        return False
+    with open(src, "rb", buffering=0) as src_file:
+        with open(dst, "wb", buffering=0) as dst_file:
+            before = os.fstat(src_file.fileno())
+            copied = 0
+            try:
+                while True:
+                    n = os.copy_file_range(
+                        src_file.fileno(), dst_file.fileno(), 1 << 30
+                    )
+                    if not n:
+                        break
+                    copied += n
+            except OSError as exc:
+                if exc.errno in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP):
+                    return False
+                raise
+            after = os.fstat(src_file.fileno())
+    if (before.st_size, before.st_mtime_ns) != (after.st_size, after.st_mtime_ns):
+        raise ValueError(f"Файл {src} изменился во время копирования")
+    if copied != after.st_size:
+        raise ValueError(f"Скопировано {copied} байт из {after.st_size}")
+    shutil.copystat(src, dst)
+    return True
+
+
+def smb_copy_file(src: str, dst_smb: str) -> str:
+    """Скопировать локальный файл на SMB с опциональной аутентификацией.
+
+    Вернёт хеш скопированных данных.
+    """
     if not smbclient:
         raise ImportError(
             "smbprotocol не установлен. Установите: pip install smbprotocol"
@@ -105,18 +313,14 @@ def smb_copy_file(src: str, dst_smb: str) -> None:
 
     host, share, path_on_share = parse_smb_path(dst_smb)
 
-    kwargs = {}
-    if SMB_USERNAME:
-        kwargs["username"] = SMB_USERNAME
-    if SMB_PASSWORD:
-        kwargs["password"] = SMB_PASSWORD
-
     # Копируем локальный файл на SMB
-    with open(src, "rb") as local_file:
+    with open(src, "rb", buffering=0) as local_file:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(local_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
         with smbclient.open_file(
-            rf"//{host}/{share}{path_on_share}", mode="wb", **kwargs
+            rf"//{host}/{share}{path_on_share}", mode="wb", **_SMB_KWARGS
         ) as smb_file:
-            shutil.copyfileobj(local_file, smb_file)
+            return pipelined_copy(local_file, smb_file)
 
 
 def setup_logging() -> None:
@@ -129,6 +333,34 @@ def setup_logging() -> None:
     )
 
 
+def log_hash_backend() -> None:
+    """Записать в лог, есть ли у CPU аппаратное ускорение SHA256.
+
+    На x86 это флаг sha_ni, на arm64 — sha2. Для других архитектур
+    проверка не выполняется.
+    """
+    if HASH_ALGO != "sha256":
+        logging.info("Хеш файлов: %s", HASH_ALGO)
+        return
+    logging.info("SHA256 считается через %s", ssl.OPENSSL_VERSION)
+    machine = platform.machine().lower()
+    if machine in ("x86_64", "amd64", "i386", "i686"):
+        flag = "sha_ni"
+    elif machine in ("aarch64", "arm64"):
+        flag = "sha2"
+    else:
+        return
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8", buffering=1 << 20) as f:
+            cpuinfo = f.read()
+    except OSError:
+        return
+    if flag not in cpuinfo.split():
+        logging.warning(
+            "CPU не поддерживает %s, хеширование SHA256 будет медленнее", flag
+        )
+
+
 def wait_for_stable_file(path: str) -> bool:
     """Дождаться стабильного размера файла в течение STABLE_SECONDS."""
     last_size = -1
@@ -148,87 +380,372 @@ def wait_for_stable_file(path: str) -> bool:
         time.sleep(POLL_INTERVAL)
 
 
-def list_source_files() -> Iterable[str]:
+def _watch_source_dir(watcher: "inotify_simple.INotify") -> None:
+    """Ждать событий inotify и сообщать о них через _source_changed."""
+    while True:
+        try:
+            events = watcher.read()
+        except OSError as exc:
+            logging.warning(
+                "Слежение inotify за %s остановлено, переходим на опрос: %s",
+                SOURCE_DIR,
+                exc,
+            )
+            return
+        if events:
+            _source_changed.set()
+
+
+def start_source_watcher() -> None:
+    """Следить за изменениями в SOURCE_DIR через inotify (только Linux).
+
+    События будят wait_for_source_change раньше таймаута. Если inotify
+    недоступен, остаётся обычный опрос.
+    """
+    if not inotify_simple:
+        return
+    flags = inotify_simple.flags
     try:
-        for name in os.listdir(SOURCE_DIR):
-            if name == TRIGGER_FILE:
-                continue
-            path = os.path.join(SOURCE_DIR, name)
-            if os.path.isfile(path):
-                yield path
+        watcher = inotify_simple.INotify()
+        watcher.add_watch(SOURCE_DIR, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+    except OSError as exc:
+        logging.warning("inotify недоступен для %s: %s", SOURCE_DIR, exc)
+        return
+    threading.Thread(target=_watch_source_dir, args=(watcher,), daemon=True).start()
+
+
+def wait_for_source_change(timeout: float) -> None:
+    """Подождать события в SOURCE_DIR, но не дольше timeout секунд.
+
+    Таймаут нужен всегда: изменения, сделанные другими клиентами NFS/SMB,
+    через inotify не приходят.
+    """
+    _source_changed.wait(timeout)
+    _source_changed.clear()
+
+
+def wait_for_unlocked_file(path: str) -> bool:
+    """Дождаться, пока писатель снимет flock с файла (не дольше STABLE_SECONDS).
+
+    Подходит только для писателей, которые держат блокировку на время записи.
+    """
+    deadline = time.monotonic() + STABLE_SECONDS
+    while True:
+        try:
+            with open(path, "rb", buffering=0) as f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    return True
+                except BlockingIOError:
+                    pass
+        except OSError:
+            return False
+        if time.monotonic() >= deadline:
+            logging.warning("Файл %s заблокирован дольше %s с", path, STABLE_SECONDS)
+            return False
+        time.sleep(POLL_INTERVAL)
+
+
+def wait_until_ready(path: str) -> bool:
+    """Дождаться, пока запись файла завершится (способ задаёт STABLE_CHECK)."""
+    if STABLE_CHECK == "flock":
+        return wait_for_unlocked_file(path)
+    return wait_for_stable_file(path)
+
+
+def is_manifest_tmp(name: str) -> bool:
+    """Проверить, что это временный файл манифеста, который ещё пишется."""
+    return name.startswith(f"{MANIFEST_PREFIX}-") and name.endswith(".json.tmp")
+
+
+def list_source_files() -> Iterable[os.DirEntry]:
+    """Перечислить файлы SOURCE_DIR (кроме служебных) одним проходом scandir.
+
+    Тип файла берётся из результата чтения директории без отдельного stat.
+    """
+    # Триггер и кеш хешей (с его временным файлом при сохранении) не переносим
+    skipped = (TRIGGER_FILE, HASH_CACHE_FILE, f"{HASH_CACHE_FILE}.tmp")
+    try:
+        with os.scandir(SOURCE_DIR) as it:
+            for entry in it:
+                if entry.name in skipped or is_manifest_tmp(entry.name):
+                    continue
+                if entry.is_file(follow_symlinks=False):
+                    yield entry
     except FileNotFoundError:
         logging.error("Исходная директория %s недоступна", SOURCE_DIR)
 
 
-def file_hash(path: str, chunk_size: int = 1024 * 1024) -> str:
-    """Вернёт SHA256 файла."""
-    h = hashlib.sha256()
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(chunk_size), b""):
-            h.update(chunk)
-    return h.hexdigest()
+def file_hash(path: str) -> str:
+    """Вернёт хеш файла (алгоритм HASH_ALGO).
 
+    Небольшие файлы читаются целиком за один вызов, большие отображаются в
+    память (mmap), для остальных цикл чтения и хеширования выполняется
+    внутри hashlib (на C).
+    """
+    # Без буфера: file_digest сам читает файл крупными блоками
+    with open(path, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= SMALL_FILE_SIZE:
+            h = new_hasher()
+            h.update(f.readall())
+            return h.hexdigest()
+        if HASH_ALGO == "blake3":
+            # blake3 сам отображает файл в память и хеширует его в несколько потоков
+            hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
+            return hasher.update_mmap(path).hexdigest()
+        if size > MMAP_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                h = new_hasher()
+                h.update(mm)
+                return h.hexdigest()
+        return hashlib.file_digest(f, new_hasher).hexdigest()
+
+
+def load_hash_cache() -> None:
+    """Загрузить кеш хешей из SOURCE_DIR (если он есть)."""
+    _hash_cache.clear()
+    path = os.path.join(SOURCE_DIR, HASH_CACHE_FILE)
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, TypeError) as exc:
+        logging.warning("Не удалось прочитать кеш хешей %s: %s", path, exc)
+        return
+    if not isinstance(data, dict):
+        logging.warning("Кеш хешей %s имеет неверный формат, игнорируем", path)
+        return
+    # Записи неверного формата отбрасываем, чтобы не сохранять их снова
+    _hash_cache.update(
+        (src, item)
+        for src, item in data.items()
+        if isinstance(item, dict) and isinstance(item.get("digest"), str)
+    )
+
+
+def save_hash_cache() -> None:
+    """Сохранить кеш хешей, оставив только файлы, которые ещё лежат в SOURCE_DIR."""
+    path = os.path.join(SOURCE_DIR, HASH_CACHE_FILE)
+    cache = {src: item for src, item in _hash_cache.items() if os.path.exists(src)}
+    try:
+        if not cache:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        logging.warning("Не удалось сохранить кеш хешей %s: %s", path, exc)
+
+
+def cached_file_hash(path: str, stat: os.stat_result) -> str:
+    """Вернёт хеш файла, используя кеш, если файл не менялся."""
+    key = {
+        "algo": HASH_ALGO,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "inode": stat.st_ino,
+    }
+    cached = _hash_cache.get(path)
+    if cached and all(cached.get(k) == v for k, v in key.items()):
+        return cached["digest"]
+    digest = file_hash(path)
+    _hash_cache[path] = {**key, "digest": digest}
+    return digest
+
+
+def manifest_entry(
+    dir_entry: os.DirEntry, check_stable: bool = True
+) -> Tuple[bool, Dict, Optional[Tuple[int, int, int]]]:
+    """Сформировать запись манифеста для файла.
 
-def manifest_entry(path: str, check_stable: bool = True) -> Tuple[bool, Dict]:
-    """Сформировать запись манифеста для файла."""
+    Вместе с записью вернёт (размер, mtime_ns, inode) файла на момент
+    хеширования.
+    """
+    path = dir_entry.path
     for attempt in range(1, RETRY_COUNT + 1):
-        if check_stable and not wait_for_stable_file(path):
-            logging.warning("Файл %s исчез до чтения", path)
-            return False, {}
+        if check_stable and not wait_until_ready(path):
+            logging.warning("Файл %s исчез или не готов до чтения", path)
+            return False, {}, None
         try:
-            stat = os.stat(path)
-            digest = file_hash(path)
-            return True, {
-                "name": os.path.basename(path),
+            # DirEntry кеширует stat, поэтому при повторной попытке читаем заново
+            stat = dir_entry.stat() if attempt == 1 else os.stat(path)
+            digest = cached_file_hash(path, stat)
+            entry = {
+                "name": dir_entry.name,
                 "size": stat.st_size,
                 "mtime": int(stat.st_mtime),
-                "sha256": digest,
+                HASH_ALGO: digest,
             }
+            return True, entry, file_identity(stat)
         except Exception as exc:  # pylint: disable=broad-except
             logging.error("Ошибка чтения %s на попытке %s: %s", path, attempt, exc)
             if attempt < RETRY_COUNT:
                 time.sleep(RETRY_DELAY)
-    return False, {}
+    return False, {}, None
 
 
-def build_manifest(check_stable: bool = True) -> Tuple[int, int, List[Dict]]:
-    """Собрать манифест по всем файлам."""
-    found = ok = failed = 0
-    entries: List[Dict] = []
-    for src in list_source_files():
-        found += 1
-        success, entry = manifest_entry(src, check_stable)
-        if success:
-            ok += 1
-            entries.append(entry)
-        else:
-            failed += 1
-    return ok, failed, entries
+def dump_json(value: object) -> bytes:
+    """Сериализовать значение в компактный JSON (UTF-8)."""
+    if orjson:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
 
-def copy_with_hash(src: str, dst: str, check_stable: bool = True) -> bool:
-    """Копировать файл с проверкой стабильности и сверкой SHA256.
+def write_manifest_entries(
+    f: BinaryIO, sources: List[os.DirEntry], check_stable: bool = True
+) -> Tuple[int, int, List[Tuple[str, str, Optional[Tuple[int, int, int]]]]]:
+    """Записать в f записи манифеста для sources (в порядке списка).
+
+    Одновременно хешируется не больше MANIFEST_WINDOW файлов, и каждая запись
+    сразу пишется в f, поэтому готовые записи не накапливаются в памяти.
+    Вернёт (успешно, ошибки,
+    [(путь к файлу, хеш, (размер, mtime_ns, inode) при хешировании)]).
+    """
+    ok = failed = 0
+    files: List[Tuple[str, str, Optional[Tuple[int, int, int]]]] = []
+    # Хеширование в hashlib отпускает GIL, поэтому файлы обрабатываются
+    # параллельно; записи пишутся в порядке имён файлов
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        pending = iter(sources)
+        futures = deque(
+            (dir_entry, executor.submit(manifest_entry, dir_entry, check_stable))
+            for dir_entry in itertools.islice(pending, MANIFEST_WINDOW)
+        )
+        while futures:
+            dir_entry, future = futures.popleft()
+            success, entry, identity = future.result()
+            # Освободилось место в окне: отправляем следующий файл
+            next_entry = next(pending, None)
+            if next_entry is not None:
+                futures.append(
+                    (
+                        next_entry,
+                        executor.submit(manifest_entry, next_entry, check_stable),
+                    )
+                )
+            if not success:
+                failed += 1
+                continue
+            f.write(b"\n  " if ok == 0 else b",\n  ")
+            f.write(dump_json(entry))
+            ok += 1
+            files.append((dir_entry.path, entry[HASH_ALGO], identity))
+    return ok, failed, files
+
+
+def stream_manifest(
+    check_stable: bool = True,
+) -> Tuple[
+    int, int, Optional[str], List[Tuple[str, str, Optional[Tuple[int, int, int]]]]
+]:
+    """Собрать манифест по всем файлам, записывая записи по мере готовности.
+
+    Записи пишутся во временный файл, который переименовывается в манифест
+    только после записи последней строки. В памяти остаются список файлов
+    SOURCE_DIR (он сортируется по имени) и возвращаемые пути с хешами,
+    нужные для копирования.
+    Вернёт (успешно, ошибки, путь к манифесту,
+    [(путь к файлу, хеш, (размер, mtime_ns, inode) при хешировании)]).
+    Если файлов нет, манифест не создаётся и путь равен None.
+    """
+    sources = sorted(list_source_files(), key=lambda dir_entry: dir_entry.name)
+    if not sources:
+        return 0, 0, None, []
+
+    os.makedirs(SOURCE_DIR, exist_ok=True)
+    generated_at = int(time.time())
+    path = os.path.join(SOURCE_DIR, f"{MANIFEST_PREFIX}-{generated_at}.json")
+    # Если процесс прервут во время хеширования, недописанный временный файл
+    # не попадёт в следующий проход как файл данных (его пропускает
+    # list_source_files)
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(
+                b'{"generated_at":%s,"source_dir":%s,"files":['
+                % (dump_json(generated_at), dump_json(SOURCE_DIR))
+            )
+            ok, failed, files = write_manifest_entries(f, sources, check_stable)
+            f.write(b"\n]}\n")
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return ok, failed, path, files
+
+
+def copy_with_hash(
+    src: str,
+    dst: str,
+    check_stable: bool = True,
+    expected_hash: Optional[str] = None,
+    expected_identity: Optional[Tuple[int, int, int]] = None,
+) -> bool:
+    """Копировать файл с проверкой стабильности и сверкой хеша.
+
+    Если передан expected_hash (хеш из манифеста), то при копировании на SMB
+    хеш переданных данных сверяется с ним. Локально файл не хешируется
+    повторно, только если его (размер, mtime_ns, inode) совпадают с
+    expected_identity (снятыми при хешировании): тогда он переименовывается
+    (на той же файловой системе) или копируется ядром (copy_file_range).
+    Иначе файл копируется с подсчётом хеша и сверкой.
 
     Поддерживает как локальные пути, так и SMB пути (smb://host/share/path).
     """
     for attempt in range(1, RETRY_COUNT + 1):
         try:
-            if check_stable and not wait_for_stable_file(src):
-                logging.warning("Файл %s исчез до копирования", src)
+            if check_stable and not wait_until_ready(src):
+                logging.warning("Файл %s исчез или не готов до копирования", src)
                 return False
 
-            src_hash = file_hash(src)
-
+            moved = False
             if is_smb_path(dst):
                 # Копирование на SMB
                 smb_makedirs(dst)
-                smb_copy_file(src, dst)
+                src_hash = smb_copy_file(src, dst)
             else:
                 # Копирование на локальную файловую систему
-                os.makedirs(os.path.dirname(dst), exist_ok=True)
-                shutil.copy2(src, dst)
-
-            os.remove(src)
+                dst_dir = os.path.dirname(dst)
+                os.makedirs(dst_dir, exist_ok=True)
+                # Хешу из манифеста верим, только если файл не менялся после хеширования
+                trusted_hash = None
+                if expected_identity == file_identity(os.stat(src)):
+                    trusted_hash = expected_hash
+                elif expected_hash:
+                    logging.warning(
+                        "Файл %s изменился после хеширования, копируем со сверкой хеша",
+                        src,
+                    )
+                if (
+                    trusted_hash
+                    and same_filesystem(src, dst_dir)
+                    and rename_file(src, dst)
+                ):
+                    # Перенос без копирования данных
+                    moved = True
+                    src_hash = trusted_hash
+                elif trusted_hash and kernel_copy_file(src, dst):
+                    src_hash = trusted_hash
+                else:
+                    src_hash = local_copy_file(src, dst)
+
+            if expected_hash and src_hash != expected_hash:
+                raise ValueError(
+                    f"Хеш не совпадает с манифестом: {src_hash} != {expected_hash}"
+                )
+
+            if not moved:
+                os.remove(src)
             logging.info(
                 "Файл скопирован %s -> %s (попытка %s, hash=%s)",
                 src,
@@ -246,30 +763,36 @@ def copy_with_hash(src: str, dst: str, check_stable: bool = True) -> bool:
     return False
 
 
-def copy_all_files(check_stable: bool = True) -> Tuple[int, int, int]:
-    found = ok = failed = 0
-    for src in list_source_files():
-        found += 1
-        dst = os.path.join(TARGET_DIR, os.path.basename(src))
-        if copy_with_hash(src, dst, check_stable):
-            ok += 1
-        else:
-            failed += 1
-    return found, ok, failed
-
+def copy_all_files(
+    files: List[Tuple[str, Optional[str], Optional[Tuple[int, int, int]]]],
+    check_stable: bool = True,
+) -> Tuple[int, int, int]:
+    """Скопировать файлы в TARGET_DIR.
 
-def write_manifest(entries: List[Dict]) -> str:
-    os.makedirs(SOURCE_DIR, exist_ok=True)
-    manifest = {
-        "generated_at": int(time.time()),
-        "source_dir": SOURCE_DIR,
-        "files": entries,
-    }
-    filename = f"{MANIFEST_PREFIX}-{int(time.time())}.json"
-    path = os.path.join(SOURCE_DIR, filename)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(manifest, f, ensure_ascii=False, indent=2)
-    return path
+    Для каждого файла передаются путь, ожидаемый хеш и (размер, mtime_ns,
+    inode) на момент хеширования (или None, если файл не хешировался).
+    """
+    # Между проходами директории на SMB могли удалить
+    _smb_created_dirs.clear()
+    ok = failed = 0
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(
+                copy_with_hash,
+                src,
+                os.path.join(TARGET_DIR, os.path.basename(src)),
+                check_stable,
+                expected_hash=expected_hash,
+                expected_identity=expected_identity,
+            )
+            for src, expected_hash, expected_identity in files
+        ]
+        for future in as_completed(futures):
+            if future.result():
+                ok += 1
+            else:
+                failed += 1
+    return len(files), ok, failed
 
 
 def wait_for_trigger() -> str:
@@ -281,13 +804,21 @@ def process_files_once(check_stable: bool = True) -> None:
 
     Если файлов нет вообще, то ничего не делаем (не создаём манифест).
     """
-    ok, failed, entries = build_manifest(check_stable=check_stable)
-    if ok == 0 and failed == 0:
+    load_hash_cache()
+    ok, failed, manifest_path, hashed = stream_manifest(check_stable=check_stable)
+    if manifest_path is None:
         logging.info("В исходной директории нет файлов, действий не требуется.")
         return
 
-    manifest_path = write_manifest(entries)
-    copied_found, copied_ok, copied_failed = copy_all_files(check_stable=check_stable)
+    # Копируем только файлы из манифеста (с их хешами) и сам манифест
+    files: List[Tuple[str, Optional[str], Optional[Tuple[int, int, int]]]] = list(
+        hashed
+    )
+    files.append((manifest_path, None, None))
+    copied_found, copied_ok, copied_failed = copy_all_files(
+        files, check_stable=check_stable
+    )
+    save_hash_cache()
     logging.info(
         "Сводка: файлов всего=%s успешно=%s ошибки=%s; манифест=%s (успешно=%s ошибки=%s)",
         copied_found,
@@ -303,8 +834,11 @@ def run_trigger_loop() -> None:
     """Режим ожидания триггер-файла в бесконечном цикле."""
     trigger_path = wait_for_trigger()
     logging.info("Запуск в режиме trigger, триггер=%s", trigger_path)
+    start_source_watcher()
     while True:
-        if os.path.isfile(trigger_path) and wait_for_stable_file(trigger_path):
+        # Содержимое триггера не читается, поэтому его стабильность не ждём:
+        # достаточно одного stat. Стабильность данных проверяется при обработке.
+        if os.path.isfile(trigger_path):
             logging.info("Обнаружен триггер %s", trigger_path)
             process_files_once(check_stable=True)
             try:
@@ -312,7 +846,7 @@ def run_trigger_loop() -> None:
                 logging.info("Триггер %s удалён", trigger_path)
             except OSError as exc:
                 logging.error("Не удалось удалить триггер %s: %s", trigger_path, exc)
-        time.sleep(POLL_INTERVAL)
+        wait_for_source_change(POLL_INTERVAL)
 
 
 def main() -> None:
@@ -333,6 +867,36 @@ def main() -> None:
         )
         sys.exit(1)
 
+    if HASH_ALGO not in ("sha256", "blake3"):
+        logging.error(
+            "Некорректное значение HASH_ALGO=%s, ожидается 'sha256' или 'blake3'. "
+            "Завершаем работу с ошибкой.",
+            HASH_ALGO,
+        )
+        sys.exit(1)
+
+    if HASH_ALGO == "blake3" and not blake3:
+        logging.error("HASH_ALGO=blake3, но пакет blake3 не установлен.")
+        sys.exit(1)
+
+    log_hash_backend()
+
+    if STABLE_CHECK not in ("poll", "flock"):
+        logging.error(
+            "Некорректное значение STABLE_CHECK=%s, ожидается 'poll' или 'flock'. "
+            "Завершаем работу с ошибкой.",
+            STABLE_CHECK,
+        )
+        sys.exit(1)
+
+    if MAX_WORKERS < 1:
+        logging.error(
+            "Некорректное значение MAX_WORKERS=%s, ожидается целое число не меньше 1. "
+            "Завершаем работу с ошибкой.",
+            MAX_WORKERS,
+        )
+        sys.exit(1)
+
     if RUN_MODE == "cron":
         # Для работы по крону: один запуск обработки и завершение.
         logging.info("Работаем в режиме cron: один проход и выход.")